@@ -6,21 +6,24 @@ import tempfile
 import secrets
 import json
 import re
-from flask import Flask, request, jsonify, send_from_directory
+import shutil
+import hashlib
+import http.client
+import queue
+import socket
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from urllib.parse import urlsplit
+from flask import Flask, Request, Response, request, jsonify, send_from_directory
 from flask_cors import CORS
+from werkzeug.exceptions import RequestEntityTooLarge
 from werkzeug.utils import secure_filename
 
-from langchain_community.document_loaders import PyPDFLoader
-from langchain_community.document_loaders import Docx2txtLoader
-from langchain_community.document_loaders import UnstructuredExcelLoader
-from langchain_community.embeddings import SentenceTransformerEmbeddings
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_community.vectorstores import FAISS
-from langchain.chains import RetrievalQA
-from langchain_community.llms import Ollama
-from langchain_community.llms.ollama import OllamaEndpointNotFoundError
-from langchain.prompts import PromptTemplate
-from langchain.callbacks.base import BaseCallbackHandler
+# Heavy dependencies (pandas, langchain, FAISS, sentence-transformers) are imported
+# lazily inside the functions that use them, so processes that only serve static
+# files or metadata routes - and the debug reloader's watcher - start in about a second.
 from datetime import datetime
 
 # Set up logging.
@@ -34,6 +37,33 @@ logger = logging.getLogger(__name__)
 app = Flask(__name__, static_folder='public')
 CORS(app, resources={r"/*": {"origins": "*"}})  # Enable CORS for all routes
 
+# Uploads larger than this are rejected before (Content-Length) or while streaming.
+# The default matches nginx's client_max_body_size.
+DEFAULT_MAX_UPLOAD_BYTES = 50 * 1024 * 1024
+
+def _max_upload_bytes():
+    # Tolerate env files that keep an inline comment in the value ("16777216  # 16MB")
+    raw = os.environ.get('MAX_CONTENT_LENGTH', '')
+    match = re.match(r'\s*(\d+)', raw)
+    if match:
+        return int(match.group(1))
+    if raw.strip():
+        logger.warning(f"Ignoring invalid MAX_CONTENT_LENGTH={raw!r}; using {DEFAULT_MAX_UPLOAD_BYTES}")
+    return DEFAULT_MAX_UPLOAD_BYTES
+
+MAX_UPLOAD_BYTES = _max_upload_bytes()
+
+def _env_int(name, default, minimum):
+    """Read an integer setting, falling back to ``default`` and clamping to ``minimum``."""
+    raw = os.environ.get(name, '')
+    match = re.match(r'\s*(-?\d+)', raw)
+    if match:
+        return max(int(match.group(1)), minimum)
+    if raw.strip():
+        logger.warning(f"Ignoring invalid {name}={raw!r}; using {default}")
+    return default
+app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_BYTES
+
 # Generate a random admin token for security
 # In a production app, this would be set in environment variables
 ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN', secrets.token_urlsafe(16))
@@ -46,8 +76,69 @@ temp_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "temp")
 os.makedirs(uploads_dir, exist_ok=True)
 os.makedirs(temp_dir, exist_ok=True)
 
+indexes_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "indexes")
+os.makedirs(indexes_dir, exist_ok=True)
+
 # Document metadata storage
 documents = {}
+SUPPORTED_EXTENSIONS = ['.pdf', '.docx', '.xlsx', '.xls']
+
+# Embedding model and FAISS indexes shared by every session, keyed by index key
+EMBEDDING_MODEL_NAME = "all-mpnet-base-v2"
+_embeddings = None
+_embeddings_lock = threading.Lock()
+vector_stores = {}
+chunk_neighbours = {}  # index key -> nearest-neighbour chunk positions per chunk
+
+# Retrieval caching and context expansion
+RETRIEVAL_TOP_K = 7  # Chunks retrieved per query for the answer context
+RETRIEVAL_CACHE_SIZE = 128  # Cached queries per session
+RETRIEVAL_CACHE_STOPWORDS = frozenset(
+    "a an the is are was were be do does did of in on at to for from by with about "
+    "please tell me show give can could would you".split()
+)  # Ignored when matching a query against cached ones; numbers and names never are
+CHUNK_NEIGHBOUR_COUNT = 5  # Neighbours precomputed for every chunk at ingestion
+CHUNK_NEIGHBOUR_BATCH = 1024  # Chunks searched per FAISS call while precomputing neighbours
+_neighbour_jobs = set()  # Index keys whose neighbours are being computed in the background
+_neighbour_jobs_lock = threading.Lock()
+CONTEXT_EXPANSION_CHUNKS = 3  # Extra neighbour chunks added when expand_context is requested
+
+# Ollama generation settings for session-level generation
+OLLAMA_BASE_URL = os.environ.get('OLLAMA_BASE_URL', 'http://localhost:11434')
+OLLAMA_KEEP_ALIVE = os.environ.get('OLLAMA_KEEP_ALIVE', '30m')
+OLLAMA_NUM_CTX = 8192  # Increased context window for handling more content
+OLLAMA_NUM_PREDICT = 2048  # Increased token generation limit
+OLLAMA_TIMEOUT = 300  # Seconds to wait on any single socket operation
+MAX_CONVERSATIONS_PER_SESSION = 256
+
+# Cancellable queries: NDJSON heartbeats let the server notice clients that left
+QUERY_HEARTBEAT_SECONDS = 1.0
+query_metrics = {
+    "queries_started": 0,
+    "queries_completed": 0,
+    "queries_cancelled": 0,
+    "cancelled_by_reason": {},
+    "cancelled_before_retrieval": 0,
+    "tokens_generated": 0,
+    "tokens_discarded": 0,
+    "cancelled_work_seconds": 0.0
+}
+metrics_lock = threading.Lock()
+
+# Bulk question answering: generations run concurrently up to this bound
+BATCH_MAX_QUERIES = 1000
+BATCH_MAX_PARALLEL = _env_int('BATCH_MAX_PARALLEL', 2, minimum=1)
+
+# Optional background warm-up of the embedding model and recently used indexes
+WARMUP_ON_START = os.environ.get('WARMUP_ON_START', '').lower() in ('1', 'true', 'yes')
+WARMUP_INDEX_COUNT = _env_int('WARMUP_INDEX_COUNT', 3, minimum=0)
+warmup_state = {
+    "status": "pending" if WARMUP_ON_START else "disabled",
+    "started_at": None,
+    "finished_at": None,
+    "indexes_loaded": 0,
+    "error": None
+}
 
 # System prompts storage with enhanced templates
 system_prompts = {
@@ -141,17 +232,6 @@ Provide only the essential information needed to answer the question:""",
     }
 }
 
-# =============================================================================
-# Callback handler for streaming output
-# =============================================================================
-class StreamingCallbackHandler(BaseCallbackHandler):
-    """A callback handler that collects tokens for streaming."""
-    def __init__(self):
-        self.tokens = []
-        
-    def on_llm_new_token(self, token: str, **kwargs) -> None:
-        self.tokens.append(token)
-
 # =============================================================================
 # Post-processing functions for improved output quality
 # =============================================================================
@@ -233,11 +313,468 @@ def get_ollama_models():
         logger.exception("Error detecting Ollama models: %s", str(e))
         return []
 
+# =============================================================================
+# Tabular ingestion for spreadsheets: row-group chunks and column-value index
+# =============================================================================
+TABULAR_CHUNK_CHARS = 1200  # Same budget as the prose splitter's chunk_size
+TABULAR_MAX_KEY_LENGTH = 64  # Longer cell values are treated as free text, not keys
+TABULAR_MIN_BARE_NUMBER_DIGITS = 3  # "price for 12" is too likely to be a count, not an ID
+TABULAR_KEY_HEADER = re.compile(r'(?<![a-z])(id|ids|code|key|sku|ref|reference|name|number|no)(?![a-z])')
+# Comparison and aggregation questions need more than one row, so they go to retrieval
+TABULAR_MULTI_ROW_WORDS = re.compile(
+    r'(?<![a-z])(than|vs|versus|compare|compared|comparison|difference|between|higher|lower|'
+    r'greater|less|more|fewer|bigger|smaller|highest|lowest|most|least|max|maximum|min|minimum|'
+    r'top|bottom|rank|total|sum|average|avg|mean|median|count|how many|all|each|every)(?![a-z])'
+)
+
+def _cell_text(value):
+    """Render a cell value as text, dropping the float suffix pandas adds to integer IDs."""
+    text = str(value).strip()
+    if re.fullmatch(r'-?\d+\.0+', text):
+        text = text.split('.')[0]
+    return text
+
+def _normalize_text(text):
+    """Normalize a cell value or query fragment for exact matching."""
+    return ' '.join(str(text).lower().split())
+
+def _is_numeric_text(text):
+    return re.fullmatch(r'-?\d+(\.\d+)?', text) is not None
+
+class TabularIndex:
+    """Column-value index over spreadsheet rows for exact lookups.
+
+    Identifier-like columns (unique values, and either an ID/code/name style header
+    or no numeric values) are indexed as keys, so a question such as "what is the
+    price for ID 123" can be answered straight from the matching row without a
+    vector search or an LLM call.
+    """
+    def __init__(self):
+        self.rows = []  # (sheet name, spreadsheet row number, {column: cell text})
+        self.keys = {}  # normalized key value -> list of (row position, key column)
+
+    def add_sheet(self, sheet_name, df):
+        """Index a sheet's rows and return the columns used as keys."""
+        key_columns = []
+        for column in df.columns:
+            values = df[column]
+            if not (values.notna().all() and values.is_unique):
+                continue
+            texts = values.map(_cell_text)
+            if texts.map(len).max() > TABULAR_MAX_KEY_LENGTH:
+                continue
+            # Unique numeric columns such as prices or totals are measurements, not keys
+            if TABULAR_KEY_HEADER.search(str(column).lower()) or not texts.map(_is_numeric_text).any():
+                key_columns.append(column)
+        columns = list(df.columns)
+        for row_label, *values in df.itertuples(index=True, name=None):
+            record = {
+                str(column): _cell_text(value)
+                for column, value in zip(columns, values)
+                if not _is_missing(value) and _cell_text(value)
+            }
+            position = len(self.rows)
+            # Header is spreadsheet row 1, so data row N lives at N + 2 (0-based labels)
+            self.rows.append((sheet_name, row_label + 2, record))
+            for column in key_columns:
+                key = _normalize_text(record.get(str(column), ''))
+                if key:
+                    self.keys.setdefault(key, []).append((position, str(column)))
+        return [str(column) for column in key_columns]
+
+    def lookup(self, query):
+        """Answer an exact "<column> for <key>" question about a single row, or return None."""
+        normalized_query = _normalize_text(query)
+        if TABULAR_MULTI_ROW_WORDS.search(normalized_query):
+            return None
+        words = [w.strip('.#') for w in re.findall(r'[^\s,;:?!"\'()]+', normalized_query)]
+
+        matches = {}
+        mentioned = set()
+        for size in range(1, 4):
+            for start in range(len(words) - size + 1):
+                candidate = ' '.join(words[start:start + size])
+                for position, key_column in self.keys.get(candidate, []):
+                    mentioned.add(position)
+                    if self._introduces_key(words[:start], key_column, candidate):
+                        matches.setdefault(position, key_column)
+        if len(matches) != 1 or len(mentioned) != 1:
+            # Nothing matched, or the question mentions keys of several rows
+            return None
+
+        position, key_column = next(iter(matches.items()))
+        sheet_name, row_number, record = self.rows[position]
+        requested = [
+            column for column in record
+            if column != key_column
+            and re.search(r'(?<!\w)' + re.escape(_normalize_text(column)) + r'(?!\w)', normalized_query)
+        ]
+        if not requested:
+            return None
+
+        facts = "; ".join(
+            f"{column} for {key_column} {record[key_column]} is {record[column]}"
+            for column in requested
+        )
+        return f"{facts} (sheet '{sheet_name}', row {row_number})."
+
+    @staticmethod
+    def _introduces_key(preceding_words, key_column, candidate):
+        """Accept a key only right after its column name ("ID 123") or "for"/"of"."""
+        column_words = _normalize_text(key_column).split()
+        if preceding_words[-len(column_words):] == column_words:
+            return True
+        if preceding_words[-1:] in (["for"], ["of"]):
+            # A bare small number after "for"/"of" is far more often a count than an ID
+            return not (_is_numeric_text(candidate) and len(candidate) < TABULAR_MIN_BARE_NUMBER_DIGITS)
+        return False
+
+def _is_missing(value):
+    import pandas as pd
+    try:
+        return bool(pd.isna(value))
+    except (TypeError, ValueError):
+        return False
+
+def load_tabular_document(filepath):
+    """Load every sheet of a workbook as row-group chunks plus a column-value index.
+
+    Every row is written as "column: value" pairs, so a chunk carries its own header
+    context. Rows wider than TABULAR_CHUNK_CHARS are split into column slices that
+    each repeat the row's key, keeping every chunk within the prose splitter's budget
+    and the embedding model's input window.
+    """
+    import pandas as pd
+
+    sheets = pd.read_excel(filepath, sheet_name=None, dtype=object)
+    tabular_index = TabularIndex()
+    chunks = []
+
+    for sheet_name, df in sheets.items():
+        df = df.dropna(how='all').dropna(axis=1, how='all')
+        if df.empty:
+            continue
+        df.columns = [str(column).strip() for column in df.columns]
+        key_columns = tabular_index.add_sheet(sheet_name, df)
+
+        header = f"Sheet: {sheet_name}\n"
+        budget = TABULAR_CHUNK_CHARS - len(header)
+        lines, first_row, size = [], None, 0
+        for _, row_number, record in tabular_index.rows[-len(df):]:
+            for line in _tabular_row_lines(row_number, record, key_columns, budget):
+                if lines and size + len(line) > budget:
+                    chunks.append(_tabular_chunk(filepath, sheet_name, header, lines, first_row))
+                    lines, first_row, size = [], None, 0
+                if first_row is None:
+                    first_row = row_number
+                lines.append(line)
+                size += len(line) + 1
+        if lines:
+            chunks.append(_tabular_chunk(filepath, sheet_name, header, lines, first_row))
+
+    logger.info(f"Loaded {len(sheets)} sheet(s) into {len(chunks)} row-group chunks "
+                f"with {len(tabular_index.keys)} indexed key values")
+    return chunks, tabular_index
+
+def _tabular_row_lines(row_number, record, key_columns, budget):
+    """Render one row as a single line, or as column slices of at most ``budget`` chars."""
+    key_column = next((c for c in key_columns if c in record), None)
+    label = f"Row {row_number}"
+    if key_column is not None:
+        label += f" ({key_column}: {record[key_column]})"
+    label += ": "
+
+    pairs = [f"{c}: {v}" for c, v in record.items() if c != key_column]
+    line = label + "; ".join(pairs)
+    if len(line) <= budget:
+        return [line]
+
+    # Wide row: every slice repeats the label so it can still be tied to its row
+    room = max(budget - len(label), 1)
+    lines, current = [], []
+    for pair in pairs:
+        # A single oversized cell is cut into pieces that fit on their own
+        pieces = [pair[i:i + room] for i in range(0, len(pair), room)]
+        for piece in pieces:
+            if current and len("; ".join(current + [piece])) > room:
+                lines.append(label + "; ".join(current))
+                current = []
+            current.append(piece)
+    if current:
+        lines.append(label + "; ".join(current))
+    return lines
+
+def _tabular_chunk(filepath, sheet_name, header, lines, first_row):
+    from langchain.schema import Document
+
+    return Document(
+        page_content=header + "\n".join(lines),
+        metadata={"source": filepath, "sheet": sheet_name, "first_row": first_row}
+    )
+
+# =============================================================================
+# Shared embedding model and persisted FAISS indexes
+# =============================================================================
+def get_embeddings():
+    """Return the process-wide sentence-transformers model, loading it on first use."""
+    global _embeddings
+    with _embeddings_lock:
+        if _embeddings is None:
+            from langchain_community.embeddings import SentenceTransformerEmbeddings
+
+            # Use more powerful embeddings for better semantic matching
+            _embeddings = SentenceTransformerEmbeddings(model_name=EMBEDDING_MODEL_NAME)
+            logger.info(f"Loaded embedding model {EMBEDDING_MODEL_NAME}")
+        return _embeddings
+
+def _index_key(filepath, similarity_metric):
+    """Identify an index by file path, size, modification time and similarity metric."""
+    stat = os.stat(filepath)
+    raw = f"{os.path.abspath(filepath)}|{stat.st_size}|{stat.st_mtime_ns}|{similarity_metric}"
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+def has_vector_store(filepath, similarity_metric):
+    """Check whether an index for this file and metric is in memory or on disk."""
+    key = _index_key(filepath, similarity_metric)
+    return key in vector_stores or os.path.isdir(os.path.join(indexes_dir, key))
+
+def _load_vector_store(index_path, similarity_metric):
+    from langchain_community.vectorstores import FAISS
+
+    return FAISS.load_local(index_path, get_embeddings(), distance_strategy=similarity_metric)
+
+def get_vector_store(filepath, splits, similarity_metric):
+    """Return the FAISS index for a file, from memory, from disk, or freshly built.
+
+    Built indexes are saved under ``indexes_dir`` so that restarts and warm-up can
+    load them instead of re-embedding; the directory's mtime records last use.
+    """
+    from langchain_community.vectorstores import FAISS
+
+    key = _index_key(filepath, similarity_metric)
+    index_path = os.path.join(indexes_dir, key)
+
+    if key in vector_stores:
+        vectordb = vector_stores[key]
+    elif os.path.isdir(index_path):
+        vectordb = _load_vector_store(index_path, similarity_metric)
+        logger.info(f"Loaded cached vector index {key}")
+    else:
+        # Build FAISS index with specified similarity metric
+        # Using cosine by default for better semantic matching
+        vectordb = FAISS.from_documents(
+            splits, 
+            get_embeddings(),
+            distance_strategy=similarity_metric  # Use the specified similarity metric
+        )
+        vectordb.save_local(index_path)
+        with open(os.path.join(index_path, "meta.json"), "w") as f:
+            json.dump({"source": filepath, "similarity_metric": similarity_metric}, f)
+
+    vector_stores[key] = vectordb
+    _ensure_neighbours(key, vectordb)
+    os.utime(index_path)
+    return vectordb
+
+def _ensure_neighbours(key, vectordb):
+    """Load a chunk's precomputed neighbour lists, or start computing them in the background.
+
+    Until the lists are ready, context expansion simply adds no neighbours.
+    """
+    if key in chunk_neighbours:
+        return
+    neighbours_path = os.path.join(indexes_dir, key, "neighbours.json")
+    if os.path.isfile(neighbours_path):
+        with open(neighbours_path) as f:
+            chunk_neighbours[key] = json.load(f)
+        return
+
+    with _neighbour_jobs_lock:
+        if key in _neighbour_jobs:
+            return
+        _neighbour_jobs.add(key)
+    threading.Thread(target=_compute_neighbours, args=(key, vectordb), name="neighbours", daemon=True).start()
+
+def _compute_neighbours(key, vectordb):
+    """Search every chunk's vector against the index in batches and save the neighbour lists."""
+    try:
+        index = vectordb.index
+        k = min(CHUNK_NEIGHBOUR_COUNT + 1, index.ntotal)
+        neighbours = []
+        for start in range(0, index.ntotal, CHUNK_NEIGHBOUR_BATCH):
+            vectors = index.reconstruct_n(start, min(CHUNK_NEIGHBOUR_BATCH, index.ntotal - start))
+            _, indices = index.search(vectors, k)
+            neighbours.extend(
+                [int(j) for j in row if j != start + offset and j != -1][:CHUNK_NEIGHBOUR_COUNT]
+                for offset, row in enumerate(indices)
+            )
+
+        index_path = os.path.join(indexes_dir, key)
+        if not os.path.isdir(index_path):
+            return  # The index was dropped while we were working
+        neighbours_path = os.path.join(index_path, "neighbours.json")
+        with open(neighbours_path + ".tmp", "w") as f:
+            json.dump(neighbours, f)
+        os.replace(neighbours_path + ".tmp", neighbours_path)
+        chunk_neighbours[key] = neighbours
+        logger.info(f"Precomputed neighbours for {len(neighbours)} chunks of index {key}")
+    except Exception as e:
+        logger.exception("Error precomputing chunk neighbours: %s", str(e))
+    finally:
+        with _neighbour_jobs_lock:
+            _neighbour_jobs.discard(key)
+
+def drop_vector_stores(filepath):
+    """Forget and delete every cached index built from a file that no session still uses."""
+    in_use = {session.get("index_key") for session in qa_chains.values()}
+    for key in os.listdir(indexes_dir):
+        meta_path = os.path.join(indexes_dir, key, "meta.json")
+        if key in in_use or not os.path.isfile(meta_path):
+            continue
+        with open(meta_path) as f:
+            meta = json.load(f)
+        if meta.get("source") == filepath:
+            vector_stores.pop(key, None)
+            chunk_neighbours.pop(key, None)
+            shutil.rmtree(os.path.join(indexes_dir, key), ignore_errors=True)
+            logger.info(f"Removed cached vector index {key}")
+
+# =============================================================================
+# Per-session retrieval cache and neighbour-based context expansion
+# =============================================================================
+class RetrievalCache:
+    """Per-session cache of top-k chunk positions and scores for recent queries.
+
+    A query that matches a cached one apart from case, punctuation and stopwords
+    skips embedding and search entirely. Near matches by embedding similarity are
+    deliberately not reused: "revenue in 2022" and "revenue in 2023" embed almost
+    identically but need different chunks.
+    """
+    def __init__(self, size=RETRIEVAL_CACHE_SIZE):
+        self.entries = OrderedDict()  # cache key -> (k, [(position, score)])
+        self.size = size
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key_for(query_text):
+        words = re.findall(r'\w+', query_text.lower())
+        return ' '.join(w for w in words if w not in RETRIEVAL_CACHE_STOPWORDS)
+
+    def get(self, key, k):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] < k:
+                return None
+            self.entries.move_to_end(key)
+            return entry[1][:k]
+
+    def put(self, key, k, hits):
+        with self.lock:
+            self.entries[key] = (k, hits)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+def _search_vectors(vectordb, vectors, k):
+    """Search the FAISS index directly, returning (position, score) hits per query vector."""
+    import faiss
+
+    if getattr(vectordb, "_normalize_L2", False):
+        faiss.normalize_L2(vectors)
+    scores, indices = vectordb.index.search(vectors, k)
+    return [
+        [(int(i), float(score)) for i, score in zip(index_row, score_row) if i != -1]
+        for index_row, score_row in zip(indices, scores)
+    ]
+
+def _chunk_at(vectordb, position):
+    return vectordb.docstore.search(vectordb.index_to_docstore_id[position])
+
+def retrieve_chunks(session, query_text, expand_context=False):
+    """Return the session's top-k chunks for a query, served from its retrieval cache when possible.
+
+    With ``expand_context`` the precomputed nearest neighbours of the hits are
+    appended, up to CONTEXT_EXPANSION_CHUNKS extra chunks.
+    """
+    import numpy as np
+
+    vectordb = session["vectordb"]
+    cache = session["retrieval_cache"]
+    k = session["k"]
+    cache_key = RetrievalCache.key_for(query_text) or _normalize_text(query_text)
+
+    hits = cache.get(cache_key, k)
+    if hits is None:
+        vector = np.array(get_embeddings().embed_query(query_text), dtype=np.float32)
+        hits = _search_vectors(vectordb, vector.reshape(1, -1), k)[0]
+        cache.put(cache_key, k, hits)
+
+    positions = [position for position, _ in hits]
+    if expand_context:
+        neighbours = chunk_neighbours.get(session["index_key"], [])
+        extra = []
+        for position in positions:
+            for neighbour in neighbours[position] if position < len(neighbours) else []:
+                if neighbour not in positions and neighbour not in extra:
+                    extra.append(neighbour)
+        positions += extra[:CONTEXT_EXPANSION_CHUNKS]
+
+    return [_chunk_at(vectordb, position) for position in positions]
+
+# =============================================================================
+# Background warm-up: embedding model and most recently used indexes
+# =============================================================================
+def warm_up():
+    """Preload the embedding model and the most recently used FAISS indexes."""
+    warmup_state.update(status="running", started_at=str(datetime.now()))
+    try:
+        get_embeddings()
+
+        index_paths = [
+            os.path.join(indexes_dir, name) for name in os.listdir(indexes_dir)
+            if os.path.isfile(os.path.join(indexes_dir, name, "meta.json"))
+        ]
+        index_paths.sort(key=os.path.getmtime, reverse=True)
+        for index_path in index_paths[:WARMUP_INDEX_COUNT]:
+            key = os.path.basename(index_path)
+            if key in vector_stores:
+                continue
+            with open(os.path.join(index_path, "meta.json")) as f:
+                meta = json.load(f)
+            vector_stores[key] = _load_vector_store(index_path, meta["similarity_metric"])
+            _ensure_neighbours(key, vector_stores[key])
+            warmup_state["indexes_loaded"] += 1
+
+        warmup_state["status"] = "ready"
+        logger.info(f"Warm-up complete: {warmup_state['indexes_loaded']} index(es) preloaded")
+    except Exception as e:
+        logger.exception("Error during warm-up: %s", str(e))
+        warmup_state.update(status="failed", error=str(e))
+    finally:
+        warmup_state["finished_at"] = str(datetime.now())
+
+def start_warmup():
+    """Run warm-up in a daemon thread so the server starts accepting requests immediately."""
+    threading.Thread(target=warm_up, name="warmup", daemon=True).start()
+
 # =============================================================================
 # Initialize the QA Chain using document type-specific loaders
 # =============================================================================
-def initialize_qa_chain(filepath, model_checkpoint, prompt_id="default", temperature=0.0, 
-                       similarity_metric="cosine"):
+def load_document_splits(filepath):
+    """Load a document with its type-specific loader and split it into chunks.
+
+    Returns the chunks and, for spreadsheets, the column-value index.
+    """
+    from langchain_community.document_loaders import PyPDFLoader
+    from langchain_community.document_loaders import Docx2txtLoader
+    from langchain_community.document_loaders import UnstructuredExcelLoader
+    from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+    tabular_index = None
     try:
         # Determine the document type based on file extension
         file_extension = os.path.splitext(filepath)[1].lower()
@@ -250,8 +787,12 @@ def initialize_qa_chain(filepath, model_checkpoint, prompt_id="default", tempera
             loader = Docx2txtLoader(filepath)
             documents = loader.load()
         elif file_extension in ['.xlsx', '.xls']:
-            loader = UnstructuredExcelLoader(filepath, mode="elements")
-            documents = loader.load()
+            try:
+                documents, tabular_index = load_tabular_document(filepath)
+            except Exception as e:
+                logger.warning(f"Tabular loading failed, falling back to element loader: {str(e)}")
+                loader = UnstructuredExcelLoader(filepath, mode="elements")
+                documents = loader.load()
         else:
             raise ValueError(f"Unsupported file type: {file_extension}. Supported formats are PDF, DOCX, XLSX, and XLS.")
             
@@ -261,82 +802,322 @@ def initialize_qa_chain(filepath, model_checkpoint, prompt_id="default", tempera
         raise ValueError(f"Failed to load the document. The error was: {str(e)}")
 
     try:
-        # Optimized chunking parameters for better semantic coherence
-        text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=1200,  # Balanced chunk size for semantic coherence
-            chunk_overlap=200, # Higher overlap to maintain context between chunks
-            separators=["\n\n", "\n", ". ", " ", ""]
-        )
-        splits = text_splitter.split_documents(documents)
+        if tabular_index is not None:
+            # Spreadsheet rows are already grouped into chunks with their headers
+            splits = documents
+        else:
+            # Optimized chunking parameters for better semantic coherence
+            text_splitter = RecursiveCharacterTextSplitter(
+                chunk_size=1200,  # Balanced chunk size for semantic coherence
+                chunk_overlap=200, # Higher overlap to maintain context between chunks
+                separators=["\n\n", "\n", ". ", " ", ""]
+            )
+            splits = text_splitter.split_documents(documents)
         logger.info(f"Document split into {len(splits)} chunks")
     except Exception as e:
         logger.exception("Error splitting document: %s", str(e))
         raise ValueError("Failed to split the document for processing.")
 
+    return splits, tabular_index
+
+def initialize_indexes(filepath, similarity_metric="cosine"):
+    """Load or build the vector index, plus the column index for spreadsheets."""
+    file_extension = os.path.splitext(filepath)[1].lower()
+    splits, tabular_index = None, None
+    # Spreadsheets always load so the column index is available; other documents
+    # skip loading and splitting when their vector index is already cached
+    if file_extension in ['.xlsx', '.xls'] or not has_vector_store(filepath, similarity_metric):
+        splits, tabular_index = load_document_splits(filepath)
+
     try:
-        # Use more powerful embeddings for better semantic matching
-        embeddings = SentenceTransformerEmbeddings(model_name="all-mpnet-base-v2")
-        
-        # Build FAISS index with specified similarity metric
-        # Using cosine by default for better semantic matching
-        vectordb = FAISS.from_documents(
-            splits, 
-            embeddings,
-            distance_strategy=similarity_metric  # Use the specified similarity metric
-        )
+        # Reuse the index built for this exact file and metric when there is one
+        vectordb = get_vector_store(filepath, splits, similarity_metric)
         logger.info(f"Vector database created with {similarity_metric} similarity metric")
     except Exception as e:
         logger.exception("Error creating embeddings/vector store: %s", str(e))
         raise ValueError("Failed to create embeddings or vector store.")
 
-    try:
-        # Get the system prompt
-        prompt_template = system_prompts.get(prompt_id, system_prompts["default"])
-        
-        # Create prompt template
-        custom_prompt = PromptTemplate(
-            input_variables=["context", "question"],
-            template=prompt_template["prompt"]
-        )
-        
-        # Initialize the Ollama LLM using the selected local model with temperature
-        llm = Ollama(
-            model=model_checkpoint, 
-            temperature=float(temperature),
-            num_ctx=8192,  # Increased context window for handling more content
-            num_predict=2048  # Increased token generation limit
-        )
-    except Exception as e:
-        logger.exception("Error initializing the Ollama LLM: %s", str(e))
-        raise ValueError("Failed to initialize the language model. Check your model configuration.")
+    return vectordb, tabular_index
 
-    try:
-        qa_chain = RetrievalQA.from_chain_type(
-            llm=llm,
-            chain_type="stuff",
-            retriever=vectordb.as_retriever(
-                search_kwargs={"k": 7}  # Retrieve more chunks for better context
-            ),
-            chain_type_kwargs={"prompt": custom_prompt}
+# =============================================================================
+# Query cancellation and metrics
+# =============================================================================
+class QueryCancelled(Exception):
+    """Raised when a query's client disconnects or its deadline passes."""
+    def __init__(self, reason, tokens=0, stage="generation"):
+        super().__init__(f"Query cancelled: {reason}")
+        self.reason = reason
+        self.tokens = tokens  # Tokens generated before the cancellation (wasted work)
+        self.stage = stage
+
+class CancellationToken:
+    """Cancellation state shared by the retrieval and generation steps of a query.
+
+    Cancelling runs the registered callbacks, which shut down in-flight Ollama
+    connections so the server stops generating instead of finishing for nobody.
+    An optional deadline cancels the token automatically.
+    """
+    def __init__(self, deadline_seconds=None):
+        self.started = time.monotonic()
+        self.reason = None
+        self._callbacks = []
+        self._lock = threading.Lock()
+        self._timer = None
+        if deadline_seconds:
+            self._timer = threading.Timer(float(deadline_seconds), self.cancel, args=("deadline_exceeded",))
+            self._timer.daemon = True
+            self._timer.start()
+
+    @property
+    def cancelled(self):
+        return self.reason is not None
+
+    def cancel(self, reason):
+        with self._lock:
+            if self.reason is not None:
+                return
+            self.reason = reason
+            callbacks = list(self._callbacks)
+        for callback in callbacks:
+            try:
+                callback()
+            except OSError:
+                pass  # The connection was already closed
+
+    def check(self, stage="generation"):
+        if self.reason is not None:
+            raise QueryCancelled(self.reason, stage=stage)
+
+    def add_callback(self, callback):
+        with self._lock:
+            if self.reason is None:
+                self._callbacks.append(callback)
+                return
+        callback()
+
+    def remove_callback(self, callback):
+        with self._lock:
+            if callback in self._callbacks:
+                self._callbacks.remove(callback)
+
+    def finish(self):
+        """Stop the deadline timer once the query is over."""
+        if self._timer is not None:
+            self._timer.cancel()
+
+def record_metric(name, amount=1):
+    with metrics_lock:
+        query_metrics[name] += amount
+
+def record_cancellation(error, started=None):
+    """Account for the work thrown away by a cancelled query that began at ``started``."""
+    with metrics_lock:
+        query_metrics["queries_cancelled"] += 1
+        by_reason = query_metrics["cancelled_by_reason"]
+        by_reason[error.reason] = by_reason.get(error.reason, 0) + 1
+        query_metrics["tokens_discarded"] += error.tokens
+        if error.stage == "retrieval":
+            query_metrics["cancelled_before_retrieval"] += 1
+        if started is not None:
+            query_metrics["cancelled_work_seconds"] += time.monotonic() - started
+    logger.info(f"Query cancelled ({error.reason}) during {error.stage} after {error.tokens} tokens")
+
+def parse_deadline(value):
+    """Validate an optional ``deadline_seconds`` request value; raises ValueError if invalid."""
+    if value is None:
+        return None
+    deadline = float(value)
+    if not deadline > 0 or deadline == float("inf"):
+        raise ValueError("deadline_seconds must be a positive number")
+    return deadline
+
+def _ollama_connection():
+    parts = urlsplit(OLLAMA_BASE_URL)
+    connection_class = http.client.HTTPSConnection if parts.scheme == "https" else http.client.HTTPConnection
+    return connection_class(parts.hostname, parts.port, timeout=OLLAMA_TIMEOUT)
+
+# =============================================================================
+# Session-level generation with Ollama keep-alive and prompt-prefix reuse
+# =============================================================================
+def _split_prompt_template(template):
+    """Split a system prompt into its fixed instructions and the per-turn part.
+
+    The per-turn part starts at the paragraph holding ``{context}`` (so headings
+    such as "Document Excerpts:" stay with it); everything before is identical on
+    every request and forms the reusable prompt prefix.
+    """
+    position = template.find("{context}")
+    if position == -1:
+        return "", template
+    paragraph = template.rfind("\n\n", 0, position)
+    start = paragraph + 2 if paragraph != -1 else template.rfind("\n", 0, position) + 1
+    return template[:start], template[start:]
+
+class GenerationSession:
+    """Ollama generation state for one chat session.
+
+    Every request carries ``keep_alive`` so the model stays loaded between turns,
+    and the system instructions always come first so Ollama's prompt cache can
+    reuse the evaluated prefix. In conversation-memory mode the token context
+    returned by Ollama is sent back on the next turn, so follow-ups submit only
+    the new excerpts and question instead of the whole prompt again.
+    """
+    def __init__(self, model, prompt_template, temperature=0.0):
+        self.model = model
+        self.temperature = float(temperature)
+        self.prefix, self.turn_template = _split_prompt_template(prompt_template)
+        self.contexts = OrderedDict()  # conversation ID -> Ollama token context
+
+    def pin_model(self):
+        """Load the model in the background and keep it resident for OLLAMA_KEEP_ALIVE."""
+        def _pin():
+            connection = _ollama_connection()
+            try:
+                connection.request(
+                    "POST", "/api/generate",
+                    body=json.dumps({"model": self.model, "keep_alive": OLLAMA_KEEP_ALIVE}),
+                    headers={"Content-Type": "application/json"}
+                )
+                connection.getresponse().read()
+            except (OSError, http.client.HTTPException) as e:
+                logger.warning(f"Could not preload Ollama model {self.model}: {str(e)}")
+            finally:
+                connection.close()
+
+        threading.Thread(target=_pin, daemon=True).start()
+
+    def generate(self, context_text, question, conversation_id=None, cancel_token=None, on_token=None):
+        """Generate an answer, returning the full text and the streamed tokens.
+
+        If ``cancel_token`` is cancelled mid-generation the Ollama connection is shut
+        down, which makes Ollama abort the request, and QueryCancelled is raised.
+        """
+        from langchain_community.llms.ollama import OllamaEndpointNotFoundError
+
+        turn = self.turn_template.format(context=context_text, question=question)
+        memory = self.contexts.get(conversation_id) if conversation_id else None
+
+        payload = {
+            "model": self.model,
+            "prompt": turn if memory else self.prefix + turn,
+            "stream": True,
+            "keep_alive": OLLAMA_KEEP_ALIVE,
+            "options": {
+                "temperature": self.temperature,
+                "num_ctx": OLLAMA_NUM_CTX,
+                "num_predict": OLLAMA_NUM_PREDICT
+            }
+        }
+        if memory:
+            payload["context"] = memory
+
+        tokens = []
+        final_chunk = {}
+        connection = _ollama_connection()
+
+        def _abort():
+            # Shutting the socket down also interrupts a read blocked on prompt evaluation
+            if connection.sock is not None:
+                connection.sock.shutdown(socket.SHUT_RDWR)
+
+        try:
+            connection.request("POST", "/api/generate", body=json.dumps(payload),
+                               headers={"Content-Type": "application/json"})
+            if cancel_token is not None:
+                cancel_token.add_callback(_abort)
+            response = connection.getresponse()
+            if response.status == 404:
+                raise OllamaEndpointNotFoundError(
+                    f"Ollama call failed with status code 404. Maybe your model is not found "
+                    f"and you should pull the model with `ollama pull {self.model}`."
+                )
+            if response.status >= 400:
+                raise ValueError(f"Ollama call failed with status code {response.status}: "
+                                 f"{response.read().decode('utf-8', 'replace')}")
+            for line in response:
+                if cancel_token is not None:
+                    cancel_token.check()
+                if not line.strip():
+                    continue
+                chunk = json.loads(line)
+                if chunk.get("error"):
+                    raise ValueError(f"Ollama error: {chunk['error']}")
+                if chunk.get("response"):
+                    tokens.append(chunk["response"])
+                    if on_token is not None:
+                        on_token(chunk["response"])
+                if chunk.get("done"):
+                    final_chunk = chunk
+            if cancel_token is not None:
+                cancel_token.check()
+        except QueryCancelled as e:
+            e.tokens = len(tokens)
+            raise
+        except (OSError, http.client.HTTPException, ValueError) as e:
+            if cancel_token is not None and cancel_token.cancelled:
+                raise QueryCancelled(cancel_token.reason, len(tokens)) from e
+            raise
+        finally:
+            if cancel_token is not None:
+                cancel_token.remove_callback(_abort)
+            connection.close()
+
+        if conversation_id:
+            self._remember(conversation_id, final_chunk.get("context"))
+        logger.info(
+            f"Generated with {final_chunk.get('prompt_eval_count', 0)} prompt tokens evaluated "
+            f"({'memory' if memory else 'full prompt'})"
         )
-        return qa_chain, vectordb
-    except Exception as e:
-        logger.exception("Error creating QA chain: %s", str(e))
-        raise ValueError("Failed to initialize the QA chain.")
+        return "".join(tokens), tokens
+
+    def _remember(self, conversation_id, context):
+        self.contexts.pop(conversation_id, None)
+        # Start the conversation over once half the context window is used up,
+        # leaving room for the next turn's excerpts and answer
+        if context and len(context) < OLLAMA_NUM_CTX // 2:
+            self.contexts[conversation_id] = context
+            while len(self.contexts) > MAX_CONVERSATIONS_PER_SESSION:
+                self.contexts.popitem(last=False)
+
+def build_session(filepath, model, prompt_id="default", temperature=0.0, similarity_metric="cosine"):
+    """Initialize the indexes and generation state for a chat session."""
+    vectordb, tabular_index = initialize_indexes(filepath, similarity_metric)
+    prompt_template = system_prompts.get(prompt_id, system_prompts["default"])
+    generation = GenerationSession(model, prompt_template["prompt"], temperature)
+    generation.pin_model()
+    return {
+        "k": RETRIEVAL_TOP_K,
+        "vectordb": vectordb,
+        "tabular_index": tabular_index,
+        "generation": generation,
+        "filepath": filepath,
+        "index_key": _index_key(filepath, similarity_metric),
+        "retrieval_cache": RetrievalCache()
+    }
 
 # =============================================================================
 # Process Query with Streaming Output and Improved Accuracy
 # =============================================================================
-def process_answer(query, qa_chain, vectordb=None, enhance_factual_accuracy=True, max_new_tokens=1024):
-    callback_handler = StreamingCallbackHandler()
+def process_answer(query_text, generation, retrieve, vectordb=None, enhance_factual_accuracy=True,
+                   max_new_tokens=1024, conversation_id=None, cancel_token=None, on_token=None):
+    from langchain_community.llms.ollama import OllamaEndpointNotFoundError
+
     try:
-        # Get the relevant document chunks for fact checking if needed
+        if cancel_token is not None:
+            cancel_token.check(stage="retrieval")
+        # Retrieve through the session's cache, then generate through the pinned
+        # session so the prompt prefix (or conversation context) is reused
+        retrieved = retrieve(query_text)
+        
+        # The top hits double as evidence for fact checking; no second search
         source_documents = []
         if vectordb and enhance_factual_accuracy:
-            source_documents = [doc.page_content for doc in vectordb.similarity_search(query, k=5)]
+            source_documents = [doc.page_content for doc in retrieved[:5]]
         
-        # Pass the callback handler to the chain's run method.
-        final_output = qa_chain.run(query, callbacks=[callback_handler])
+        context_text = "\n\n".join(doc.page_content for doc in retrieved)
+        final_output, tokens = generation.generate(
+            context_text, query_text, conversation_id, cancel_token, on_token
+        )
         
         # Apply post-processing to improve quality
         processed_output = post_process_answer(final_output)
@@ -345,7 +1126,9 @@ def process_answer(query, qa_chain, vectordb=None, enhance_factual_accuracy=True
         if enhance_factual_accuracy and source_documents:
             processed_output = fact_check_answer(processed_output, source_documents)
         
-        return processed_output, callback_handler.tokens
+        return processed_output, tokens
+    except QueryCancelled:
+        raise
     except OllamaEndpointNotFoundError as e:
         logger.exception("Ollama model endpoint not found: %s", str(e))
         error_msg = ("Ollama model endpoint not found. Please ensure that the specified model is pulled locally. "
@@ -356,12 +1139,153 @@ def process_answer(query, qa_chain, vectordb=None, enhance_factual_accuracy=True
         error_msg = "An error occurred while processing your query. Please try again later."
         return error_msg, [error_msg]
 
+# =============================================================================
+# Answering a single query for a session
+# =============================================================================
+def answer_query(session, query_text, enhance_factual_accuracy=True, max_new_tokens=1024,
+                 conversation_id=None, expand_context=False, cancel_token=None, on_token=None):
+    """Answer one query for a session and return the JSON payload for the client.
+
+    Raises QueryCancelled, after recording it in the metrics, when the client
+    goes away or the deadline passes before the answer is complete.
+    """
+    record_metric("queries_started")
+    
+    # Exact spreadsheet lookups are answered from the column index directly
+    tabular_index = session.get("tabular_index")
+    if tabular_index is not None:
+        indexed_answer = tabular_index.lookup(query_text)
+        if indexed_answer:
+            record_metric("queries_completed")
+            return {
+                "answer": indexed_answer,
+                "tokens": [indexed_answer],
+                "enhanced": False,
+                "source": "index"
+            }
+    
+    try:
+        result, tokens = process_answer(
+            query_text,
+            session["generation"],
+            lambda text: retrieve_chunks(session, text, expand_context),
+            session.get("vectordb"),
+            enhance_factual_accuracy,
+            max_new_tokens,
+            conversation_id,
+            cancel_token,
+            on_token
+        )
+    except QueryCancelled as e:
+        record_cancellation(e, cancel_token.started if cancel_token is not None else None)
+        raise
+    
+    record_metric("queries_completed")
+    record_metric("tokens_generated", len(tokens))
+    return {
+        "answer": result,
+        "tokens": tokens,  # For streaming support in frontend
+        "enhanced": enhance_factual_accuracy
+    }
+
+# =============================================================================
+# Batch question answering
+# =============================================================================
+def batch_retrieve(vectordb, queries, k):
+    """Embed all queries in one pass and search the FAISS index with a single call."""
+    import numpy as np
+
+    vectors = np.array(get_embeddings().embed_documents(queries), dtype=np.float32)
+    return [
+        [_chunk_at(vectordb, position) for position, _ in hits]
+        for hits in _search_vectors(vectordb, vectors, k)
+    ]
+
+def answer_from_documents(query_text, retrieved, generation, enhance_factual_accuracy=True, cancel_token=None):
+    """Generate and post-process an answer from already retrieved chunks."""
+    context_text = "\n\n".join(doc.page_content for doc in retrieved)
+    final_output, tokens = generation.generate(context_text, query_text, cancel_token=cancel_token)
+    record_metric("tokens_generated", len(tokens))
+    processed_output = post_process_answer(final_output)
+    if enhance_factual_accuracy and retrieved:
+        # Same top-5 evidence window process_answer uses for fact checking
+        processed_output = fact_check_answer(processed_output, [doc.page_content for doc in retrieved[:5]])
+    return processed_output
+
 # =============================================================================
 # Helper function to validate admin token
 # =============================================================================
 def validate_admin_token(token):
     return token == ADMIN_TOKEN
 
+# =============================================================================
+# Streamed uploads into content-addressed storage
+# =============================================================================
+class HashingUploadStream:
+    """File sink for multipart uploads that hashes and size-checks while writing.
+
+    The form parser writes each chunk straight into a file in ``temp_dir``, so the
+    upload is never buffered twice and oversized bodies fail as soon as they cross
+    MAX_UPLOAD_BYTES.
+    """
+    def __init__(self, limit):
+        self.file = tempfile.NamedTemporaryFile(dir=temp_dir, delete=False)
+        self.hash = hashlib.sha256()
+        self.size = 0
+        self.limit = limit
+
+    def write(self, data):
+        self.size += len(data)
+        if self.size > self.limit:
+            raise RequestEntityTooLarge()
+        self.hash.update(data)
+        return self.file.write(data)
+
+    def discard(self):
+        """Remove the temporary file unless it has been moved into storage."""
+        self.file.close()
+        if os.path.exists(self.file.name):
+            os.remove(self.file.name)
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+
+class UploadRequest(Request):
+    """Request that streams uploaded files through HashingUploadStream."""
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        stream = HashingUploadStream(MAX_UPLOAD_BYTES)
+        self.__dict__.setdefault("upload_streams", []).append(stream)
+        return stream
+
+app.request_class = UploadRequest
+
+@app.teardown_request
+def remove_unclaimed_uploads(exc):
+    for stream in request.__dict__.get("upload_streams", []):
+        stream.discard()
+
+def store_upload(file):
+    """Move a streamed upload into ``uploads_dir`` under its SHA-256 content hash.
+
+    Returns the stored filename, the content hash and whether identical content
+    was already stored, in which case the existing file (and its cached index,
+    keyed by path and mtime) is reused untouched.
+    """
+    stream = file.stream
+    file_extension = os.path.splitext(secure_filename(file.filename))[1].lower()
+    content_hash = stream.hash.hexdigest()
+    filename = content_hash + file_extension
+    filepath = os.path.join(uploads_dir, filename)
+
+    stream.file.close()
+    if os.path.exists(filepath):
+        logger.info(f"Upload matches stored content {filename}; reusing it")
+        return filename, content_hash, True
+    # Same filesystem as uploads_dir, so the move is atomic
+    os.replace(stream.file.name, filepath)
+    logger.info(f"Stored upload as {filename} ({stream.size} bytes)")
+    return filename, content_hash, False
+
 # =============================================================================
 # API Routes for Client
 # =============================================================================
@@ -376,6 +1300,21 @@ def get_models():
         logger.exception("Error fetching models: %s", str(e))
         return jsonify({"error": str(e)}), 500
 
+@app.route('/api/ready', methods=['GET'])
+def readiness():
+    """Report whether background warm-up has finished."""
+    # A failed warm-up is not fatal: everything still loads lazily on first use
+    ready = warmup_state["status"] in ("disabled", "ready", "failed")
+    return jsonify({"ready": ready, "warmup": warmup_state}), (200 if ready else 503)
+
+@app.route('/api/metrics', methods=['GET'])
+def get_metrics():
+    """Report query counters, including work thrown away by cancelled queries."""
+    with metrics_lock:
+        metrics = dict(query_metrics, cancelled_by_reason=dict(query_metrics["cancelled_by_reason"]))
+    metrics["cancelled_work_seconds"] = round(metrics["cancelled_work_seconds"], 3)
+    return jsonify({"metrics": metrics})
+
 @app.route('/api/documents', methods=['GET'])
 def get_documents():
     """Get list of available documents."""
@@ -433,19 +1372,9 @@ def select_document():
         filepath = os.path.join(uploads_dir, document['filename'])
         
         # Initialize QA chain with prompt, temperature and similarity metric
-        qa_chain, vectordb = initialize_qa_chain(
-            filepath, 
-            model, 
-            prompt_id, 
-            temperature,
-            similarity_metric
-        )
-        
-        qa_chains[document_id] = {
-            "chain": qa_chain,
-            "vectordb": vectordb,
-            "retrieval_options": retrieval_options
-        }
+        session = build_session(filepath, model, prompt_id, temperature, similarity_metric)
+        session["retrieval_options"] = retrieval_options
+        qa_chains[document_id] = session
         
         return jsonify({
             "success": True,
@@ -465,34 +1394,221 @@ def query():
     query_text = data.get('query')
     enhance_factual_accuracy = data.get('enhance_factual_accuracy', True)
     max_new_tokens = data.get('max_new_tokens', 1024)
+    # Conversation memory sends only the new turn; sessions can be shared by many
+    # users, so clients must pass their own conversation_id to keep histories apart
+    conversation_memory = data.get('conversation_memory', False)
+    conversation_id = data.get('conversation_id') if conversation_memory else None
+    # Append the precomputed nearest neighbours of the retrieved chunks
+    expand_context = data.get('expand_context', False)
     
     if not session_id or not query_text:
         return jsonify({"error": "Missing session_id or query"}), 400
     
+    # Stop retrieval and generation once the client would have given up anyway
+    try:
+        deadline_seconds = parse_deadline(data.get('deadline_seconds'))
+    except (TypeError, ValueError):
+        return jsonify({"error": "deadline_seconds must be a positive number"}), 400
+    
+    if conversation_memory and not conversation_id:
+        return jsonify({"error": "conversation_id is required when conversation_memory is enabled"}), 400
+    
     if session_id not in qa_chains:
         return jsonify({"error": "Session not found or expired"}), 404
     
+    cancel_token = CancellationToken(deadline_seconds)
     try:
-        qa_chain_data = qa_chains[session_id]
-        qa_chain = qa_chain_data["chain"]
-        vectordb = qa_chain_data.get("vectordb")
-        
-        result, tokens = process_answer(
-            {"query": query_text}, 
-            qa_chain, 
-            vectordb,
+        return jsonify(answer_query(
+            qa_chains[session_id],
+            query_text,
             enhance_factual_accuracy,
-            max_new_tokens
-        )
-        
-        return jsonify({
-            "answer": result,
-            "tokens": tokens,  # For streaming support in frontend
-            "enhanced": enhance_factual_accuracy
-        })
+            max_new_tokens,
+            conversation_id,
+            expand_context,
+            cancel_token
+        ))
+    except QueryCancelled as e:
+        return jsonify({"error": str(e), "cancelled": True}), 504
     except Exception as e:
         logger.exception("Error processing query: %s", str(e))
         return jsonify({"error": str(e)}), 500
+    finally:
+        cancel_token.finish()
+
+@app.route('/api/query/async', methods=['POST'])
+def query_async():
+    """Process a query in the background, streaming NDJSON tokens and the final answer.
+
+    Blank heartbeat lines are sent while waiting, so a client that disconnects is
+    noticed within QUERY_HEARTBEAT_SECONDS and its retrieval and Ollama generation
+    are cancelled; ``deadline_seconds`` cancels the same way.
+    """
+    data = request.json
+    session_id = data.get('session_id')
+    query_text = data.get('query')
+    enhance_factual_accuracy = data.get('enhance_factual_accuracy', True)
+    max_new_tokens = data.get('max_new_tokens', 1024)
+    conversation_memory = data.get('conversation_memory', False)
+    conversation_id = data.get('conversation_id') if conversation_memory else None
+    expand_context = data.get('expand_context', False)
+    
+    if not session_id or not query_text:
+        return jsonify({"error": "Missing session_id or query"}), 400
+    
+    try:
+        deadline_seconds = parse_deadline(data.get('deadline_seconds'))
+    except (TypeError, ValueError):
+        return jsonify({"error": "deadline_seconds must be a positive number"}), 400
+    
+    if conversation_memory and not conversation_id:
+        return jsonify({"error": "conversation_id is required when conversation_memory is enabled"}), 400
+    
+    if session_id not in qa_chains:
+        return jsonify({"error": "Session not found or expired"}), 404
+    
+    session = qa_chains[session_id]
+    cancel_token = CancellationToken(deadline_seconds)
+    events = queue.Queue()
+    finished = object()
+    
+    def _work():
+        try:
+            result = answer_query(
+                session,
+                query_text,
+                enhance_factual_accuracy,
+                max_new_tokens,
+                conversation_id,
+                expand_context,
+                cancel_token,
+                on_token=lambda token: events.put({"token": token})
+            )
+            events.put(dict(result, done=True))
+        except QueryCancelled as e:
+            events.put({"error": str(e), "cancelled": True, "done": True})
+        except Exception as e:
+            logger.exception("Error processing query: %s", str(e))
+            events.put({"error": str(e), "done": True})
+        finally:
+            cancel_token.finish()
+            events.put(finished)
+    
+    worker = threading.Thread(target=_work, name="query", daemon=True)
+    worker.start()
+    
+    def _stream():
+        try:
+            while True:
+                try:
+                    event = events.get(timeout=QUERY_HEARTBEAT_SECONDS)
+                except queue.Empty:
+                    yield "\n"
+                    continue
+                if event is finished:
+                    break
+                yield json.dumps(event) + "\n"
+        finally:
+            # Reached via GeneratorExit when the client disconnects mid-stream
+            if worker.is_alive():
+                cancel_token.cancel("client_disconnected")
+    
+    # Ask nginx not to buffer, so tokens and heartbeats reach the client immediately
+    return Response(_stream(), mimetype='application/x-ndjson', headers={"X-Accel-Buffering": "no"})
+
+@app.route('/api/query/batch', methods=['POST'])
+def query_batch():
+    """Answer a list of queries for one session, streaming NDJSON results as they finish."""
+    data = request.json
+    session_id = data.get('session_id')
+    queries = data.get('queries')
+    enhance_factual_accuracy = data.get('enhance_factual_accuracy', True)
+    
+    if not session_id or not queries:
+        return jsonify({"error": "Missing session_id or queries"}), 400
+    
+    try:
+        max_parallel = min(max(1, int(data.get('max_parallel', BATCH_MAX_PARALLEL))), BATCH_MAX_PARALLEL)
+    except (TypeError, ValueError):
+        return jsonify({"error": "max_parallel must be an integer"}), 400
+    
+    if not isinstance(queries, list) or not all(isinstance(q, str) and q.strip() for q in queries):
+        return jsonify({"error": "queries must be a list of non-empty strings"}), 400
+    
+    if len(queries) > BATCH_MAX_QUERIES:
+        return jsonify({"error": f"At most {BATCH_MAX_QUERIES} queries per batch"}), 400
+    
+    if session_id not in qa_chains:
+        return jsonify({"error": "Session not found or expired"}), 404
+    
+    qa_chain_data = qa_chains[session_id]
+    generation = qa_chain_data["generation"]
+    tabular_index = qa_chain_data.get("tabular_index")
+    
+    # Exact spreadsheet lookups skip retrieval and generation entirely
+    indexed_answers = {}
+    if tabular_index is not None:
+        for i, query_text in enumerate(queries):
+            answer = tabular_index.lookup(query_text)
+            if answer:
+                indexed_answers[i] = answer
+    pending = [i for i in range(len(queries)) if i not in indexed_answers]
+    
+    try:
+        k = qa_chain_data["k"]
+        retrieved = batch_retrieve(qa_chain_data["vectordb"], [queries[i] for i in pending], k) if pending else []
+    except Exception as e:
+        logger.exception("Error retrieving batch: %s", str(e))
+        return jsonify({"error": str(e)}), 500
+    
+    cancel_token = CancellationToken()
+    
+    def _answer(i, documents_for_query):
+        record_metric("queries_started")
+        started = time.monotonic()
+        try:
+            answer = answer_from_documents(
+                queries[i], documents_for_query, generation, enhance_factual_accuracy, cancel_token
+            )
+            record_metric("queries_completed")
+            return {"index": i, "query": queries[i], "answer": answer, "source": "llm"}
+        except QueryCancelled as e:
+            record_cancellation(e, started)
+            return {"index": i, "query": queries[i], "error": str(e), "cancelled": True}
+        except Exception as e:
+            logger.exception("Error answering batch query %d: %s", i, str(e))
+            return {"index": i, "query": queries[i], "error": str(e)}
+    
+    def _stream():
+        started = time.monotonic()
+        for i, answer in indexed_answers.items():
+            yield json.dumps({"index": i, "query": queries[i], "answer": answer, "source": "index"}) + "\n"
+        
+        pool = ThreadPoolExecutor(max_workers=max_parallel)
+        futures = set()
+        try:
+            futures = {pool.submit(_answer, i, docs) for i, docs in zip(pending, retrieved)}
+            while futures:
+                done, futures = wait(futures, timeout=QUERY_HEARTBEAT_SECONDS, return_when=FIRST_COMPLETED)
+                if not done:
+                    # Blank heartbeat line keeps proxies from timing out a slow generation
+                    yield "\n"
+                for future in done:
+                    yield json.dumps(future.result()) + "\n"
+        finally:
+            # If the client goes away mid-stream, drop queued generations and
+            # abort the ones already running in Ollama
+            pool.shutdown(wait=False, cancel_futures=True)
+            if futures:
+                cancel_token.cancel("client_disconnected")
+        
+        yield json.dumps({
+            "done": True,
+            "count": len(queries),
+            "elapsed_seconds": round(time.monotonic() - started, 3)
+        }) + "\n"
+    
+    # Ask nginx not to buffer, so each result reaches the client as it finishes
+    return Response(_stream(), mimetype='application/x-ndjson', headers={"X-Accel-Buffering": "no"})
 
 @app.route('/api/upload', methods=['POST'])
 def upload_file():
@@ -509,21 +1625,22 @@ def upload_file():
     if not model:
         return jsonify({"error": "No model selected"}), 400
     
+    file_extension = os.path.splitext(secure_filename(file.filename))[1].lower()
+    if file_extension not in SUPPORTED_EXTENSIONS:
+        return jsonify({
+            "error": f"Unsupported file type: {file_extension}. Supported formats are: {', '.join(SUPPORTED_EXTENSIONS)}"
+        }), 400
+    
     try:
-        # Save the file
-        filename = secure_filename(file.filename)
+        # Keep the streamed upload; identical content reuses the stored file and index
+        filename, _, _ = store_upload(file)
         filepath = os.path.join(uploads_dir, filename)
-        file.save(filepath)
         
         # Generate a unique session ID
         session_id = secrets.token_hex(16)
         
         # Initialize QA chain
-        qa_chain, vectordb = initialize_qa_chain(filepath, model)
-        qa_chains[session_id] = {
-            "chain": qa_chain,
-            "vectordb": vectordb
-        }
+        qa_chains[session_id] = build_session(filepath, model)
         
         return jsonify({
             "success": True,
@@ -579,51 +1696,56 @@ def admin_upload():
     if not model:
         return jsonify({"error": "No model selected"}), 400
     
+    original_filename = secure_filename(file.filename)
+    
+    # Get file extension
+    file_extension = os.path.splitext(original_filename)[1].lower()
+    
+    # Reject unsupported file types; the streamed temp file is discarded on teardown
+    if file_extension not in SUPPORTED_EXTENSIONS:
+        return jsonify({
+            "error": f"Unsupported file type: {file_extension}. Supported formats are: {', '.join(SUPPORTED_EXTENSIONS)}"
+        }), 400
+    
     try:
-        filename = secure_filename(file.filename)
+        filename, content_hash, _ = store_upload(file)
         filepath = os.path.join(uploads_dir, filename)
-        file.save(filepath)
-        logger.info(f"Saved file: {filepath}")
         
-        # Get file extension
-        file_extension = os.path.splitext(filename)[1].lower()
+        # Identical content is already indexed; hand back the existing document
+        for existing in documents.values():
+            if existing.get("content_hash") == content_hash:
+                return jsonify({
+                    "success": True,
+                    "message": "Document with identical content already exists",
+                    "document": existing,
+                    "duplicate": True
+                })
         
-        # Process supported file types
-        supported_extensions = ['.pdf', '.docx', '.xlsx', '.xls']
-        if file_extension in supported_extensions:
-            # Generate a unique document ID
-            document_id = os.path.splitext(filename)[0] + '_' + secrets.token_hex(4)
-            logger.info(f"Processing {file_extension} file: {filename}, ID: {document_id}")
-            
-            # Initialize QA chain with temperature 0
-            qa_chain, vectordb = initialize_qa_chain(filepath, model, "default", 0.0)
-            qa_chains[document_id] = {
-                "chain": qa_chain,
-                "vectordb": vectordb
-            }
-            
-            # Store document metadata
-            documents[document_id] = {
-                "id": document_id,
-                "title": title,
-                "description": description,
-                "filename": filename,
-                "file_type": file_extension[1:].upper(),  # Store file type without the dot
-                "model": model,
-                "created_at": str(datetime.now())
-            }
-            
-            return jsonify({
-                "success": True,
-                "message": f"{file_extension[1:].upper()} document processed successfully",
-                "document": documents[document_id]
-            })
-        else:
-            # Remove unsupported file
-            os.remove(filepath)
-            return jsonify({
-                "error": f"Unsupported file type: {file_extension}. Supported formats are: {', '.join(supported_extensions)}"
-            }), 400
+        # Generate a unique document ID
+        document_id = os.path.splitext(original_filename)[0] + '_' + secrets.token_hex(4)
+        logger.info(f"Processing {file_extension} file: {original_filename}, ID: {document_id}")
+        
+        # Initialize QA chain with temperature 0
+        qa_chains[document_id] = build_session(filepath, model, "default", 0.0)
+        
+        # Store document metadata
+        documents[document_id] = {
+            "id": document_id,
+            "title": title,
+            "description": description,
+            "filename": filename,
+            "original_filename": original_filename,
+            "content_hash": content_hash,
+            "file_type": file_extension[1:].upper(),  # Store file type without the dot
+            "model": model,
+            "created_at": str(datetime.now())
+        }
+        
+        return jsonify({
+            "success": True,
+            "message": f"{file_extension[1:].upper()} document processed successfully",
+            "document": documents[document_id]
+        })
             
     except Exception as e:
         logger.exception("Error processing file: %s", str(e))
@@ -769,16 +1891,24 @@ def admin_delete_document(document_id):
         document = documents[document_id]
         filepath = os.path.join(uploads_dir, document['filename'])
         
-        # Remove from qa_chains
-        if document_id in qa_chains:
-            del qa_chains[document_id]
+        # Remove from qa_chains, invalidating its cached retrievals
+        session = qa_chains.pop(document_id, None)
+        if session is not None:
+            session["retrieval_cache"].clear()
         
         # Remove document metadata
         del documents[document_id]
         
-        # Remove file
-        if os.path.exists(filepath):
-            os.remove(filepath)
+        # Remove file unless another document or a live session (e.g. from
+        # /api/upload) still uses the same stored content
+        still_referenced = (
+            any(d['filename'] == document['filename'] for d in documents.values())
+            or any(session.get("filepath") == filepath for session in qa_chains.values())
+        )
+        if not still_referenced:
+            if os.path.exists(filepath):
+                os.remove(filepath)
+            drop_vector_stores(filepath)
         
         return jsonify({"success": True, "message": "Document deleted successfully"})
     except Exception as e:
@@ -798,5 +1928,10 @@ def serve(path):
         return send_from_directory(app.static_folder, path)
     return send_from_directory(app.static_folder, 'index.html')
 
+# The debug reloader's watcher process never serves requests, so only warm up in
+# the serving child (WERKZEUG_RUN_MAIN) or when imported by a WSGI server.
+if WARMUP_ON_START and (__name__ != '__main__' or os.environ.get('WERKZEUG_RUN_MAIN') == 'true'):
+    start_warmup()
+
 if __name__ == '__main__':
     app.run(debug=True, host='0.0.0.0', port=5000)
@@ -118,18 +118,27 @@ export const selectDocument = async (
 
 /**
  * Process a query against a selected document
+ *
+ * Uses the streaming /api/query/async endpoint: tokens are passed to onToken as
+ * they are generated, and aborting the signal closes the stream so the backend
+ * cancels the retrieval and Ollama generation instead of finishing unseen work.
  * @param sessionId Session ID for the query
  * @param query Query text
- * @param options Additional query options
+ * @param options Additional query options; conversationMemory requires a
+ *   conversationId unique to this user's chat, since sessions can be shared
  * @returns Promise with answer and tokens
  */
 export const processQuery = async (
   sessionId: string, 
   query: string,
   options: {
-    stream?: boolean;
     enhanceFactualAccuracy?: boolean;
     maxNewTokens?: number;
+    conversationMemory?: boolean;
+    conversationId?: string;
+    deadlineSeconds?: number;
+    signal?: AbortSignal;
+    onToken?: (token: string) => void;
   } = {}
 ) => {
   if (!sessionId || !query.trim()) {
@@ -137,18 +146,66 @@ export const processQuery = async (
   }
 
   try {
-    const response = await fetchWithRetry(apiUrl('/api/query'), {
+    // Not retried: a retry would re-run generation the user may have abandoned
+    const response = await fetch(apiUrl('/api/query/async'), {
       method: 'POST',
+      headers: {
+        'Content-Type': 'application/json'
+      },
+      cache: 'no-store',
       body: JSON.stringify({
         session_id: sessionId,
         query: query,
-        stream: options.stream ?? false,
         enhance_factual_accuracy: options.enhanceFactualAccuracy ?? true,
-        max_new_tokens: options.maxNewTokens || 1024
+        max_new_tokens: options.maxNewTokens || 1024,
+        conversation_memory: options.conversationMemory ?? false,
+        deadline_seconds: options.deadlineSeconds ?? 120,
+        ...(options.conversationId ? { conversation_id: options.conversationId } : {})
       }),
+      signal: options.signal
     });
     
-    return await response.json();
+    if (!response.ok) {
+      const errorText = await response.text();
+      throw new Error(`API error (${response.status}): ${errorText}`);
+    }
+    
+    // NDJSON events: {"token"} while generating, then one {"done": true} result.
+    // Blank lines are heartbeats that let the backend notice a closed connection.
+    const reader = response.body!.getReader();
+    const decoder = new TextDecoder();
+    let buffer = "";
+    let result: any = null;
+    
+    while (result === null) {
+      const { done, value } = await reader.read();
+      buffer += decoder.decode(value, { stream: !done });
+      const lines = buffer.split("\n");
+      buffer = done ? "" : lines.pop() || "";
+      
+      for (const line of lines) {
+        if (!line.trim()) continue;
+        const event = JSON.parse(line);
+        if (event.done) {
+          result = event;
+          break;
+        }
+        if (event.token) {
+          options.onToken?.(event.token);
+        }
+      }
+      
+      if (done) break;
+    }
+    
+    if (!result) {
+      throw new Error("The query stream ended before an answer was received.");
+    }
+    if (result.error) {
+      throw new Error(result.error);
+    }
+    
+    return result;
   } catch (error) {
     console.error("Error processing query:", error);
     throw error;
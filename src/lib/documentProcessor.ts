@@ -20,7 +20,8 @@ const getApiBaseUrl = () => {
 const API_BASE_URL = getApiBaseUrl();
 const MODELS_ENDPOINT = `${API_BASE_URL}/api/models`;
 const UPLOAD_ENDPOINT = `${API_BASE_URL}/api/upload`;
-const QUERY_ENDPOINT = `${API_BASE_URL}/api/query`;
+// Streams NDJSON so the backend can cancel generation when this request is aborted
+const QUERY_ENDPOINT = `${API_BASE_URL}/api/query/async`;
 
 /**
  * Interface for the QA Chain return object
@@ -149,11 +150,11 @@ export const processQuery = async (
   qaChain: QAChainSession, 
   streamCallback?: (token: string) => void
 ): Promise<string> => {
+  // Add timeout control for query processing
+  const controller = new AbortController();
+  const timeoutId = setTimeout(() => controller.abort(), 60000); // 1-minute timeout
+  
   try {
-    // Add timeout control for query processing
-    const controller = new AbortController();
-    const timeoutId = setTimeout(() => controller.abort(), 60000); // 1-minute timeout
-    
     // Send the query to the backend
     const response = await fetch(QUERY_ENDPOINT, {
       method: 'POST',
@@ -162,13 +163,13 @@ export const processQuery = async (
       },
       body: JSON.stringify({
         session_id: qaChain.sessionId,
-        query: query
+        query: query,
+        // Let the server stop generating when this request times out
+        deadline_seconds: 60
       }),
       signal: controller.signal
     });
     
-    clearTimeout(timeoutId);
-    
     if (!response.ok) {
       // Improved error handling with status code context
       const errorText = await response.text();
@@ -182,16 +183,52 @@ export const processQuery = async (
       throw new Error(errorMessage);
     }
     
-    const data = await response.json();
+    // Read NDJSON events: {"token"} while generating, then a final {"done": true}.
+    // Blank lines are heartbeats. Aborting the fetch closes the stream, which
+    // makes the backend cancel the generation.
+    const reader = response.body!.getReader();
+    const decoder = new TextDecoder();
+    let buffer = "";
+    let result: any = null;
+    let streamed = false;
     
-    // If streaming callback is provided and tokens are available, stream them
-    if (streamCallback && data.tokens) {
-      for (const token of data.tokens) {
+    while (result === null) {
+      const { done, value } = await reader.read();
+      buffer += decoder.decode(value, { stream: !done });
+      const lines = buffer.split("\n");
+      buffer = done ? "" : lines.pop() || "";
+      
+      for (const line of lines) {
+        if (!line.trim()) continue;
+        const event = JSON.parse(line);
+        if (event.done) {
+          result = event;
+          break;
+        }
+        if (streamCallback && event.token) {
+          streamed = true;
+          streamCallback(event.token);
+        }
+      }
+      
+      if (done) break;
+    }
+    
+    if (!result) {
+      throw new Error("The query stream ended before an answer was received.");
+    }
+    if (result.error) {
+      throw new Error(result.error);
+    }
+    
+    // Answers served from a spreadsheet index arrive whole, without token events
+    if (streamCallback && !streamed && result.tokens) {
+      for (const token of result.tokens) {
         streamCallback(token);
       }
     }
     
-    return data.answer || "No answer found.";
+    return result.answer || "No answer found.";
   } catch (error: any) {
     // Better error handling with AbortController support
     if (error.name === 'AbortError') {
@@ -209,6 +246,8 @@ export const processQuery = async (
     }
     
     return error.message || "An error occurred while processing your query.";
+  } finally {
+    clearTimeout(timeoutId);
   }
 };
 
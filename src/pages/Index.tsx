@@ -109,6 +109,7 @@ const Index = () => {
   
   const messagesEndRef = useRef<HTMLDivElement>(null);
   const headerRef = useRef<HTMLDivElement>(null);
+  const queryAbortRef = useRef<AbortController | null>(null);
   const { toast } = useToast();
   const isMobile = useIsMobile();
 
@@ -234,6 +235,13 @@ const Index = () => {
     getSystemPrompts();
   }, []);
 
+  // Abort an in-flight query on unmount so the backend stops generating for it
+  useEffect(() => {
+    return () => {
+      queryAbortRef.current?.abort();
+    };
+  }, []);
+
   useEffect(() => {
     messagesEndRef.current?.scrollIntoView({ behavior: "smooth" });
   }, [messages, streamingContent]);
@@ -417,10 +425,36 @@ const Index = () => {
     setIsLoading(true);
     setStreamingContent("");
 
+    queryAbortRef.current?.abort();
+    const controller = new AbortController();
+    queryAbortRef.current = controller;
+    let streamedText = "";
+
     try {
-      const data = await processQuery(sessionId, prompt);
+      const data = await processQuery(sessionId, prompt, {
+        signal: controller.signal,
+        onToken: (token) => {
+          streamedText += token;
+          setStreamingContent(streamedText);
+        }
+      });
       
-      if (data.tokens && Array.isArray(data.tokens)) {
+      if (streamedText) {
+        const assistantMessage: Message = { role: "assistant", content: data.answer || streamedText };
+        
+        if (activeChatId) {
+          setChatSessions(prev => prev.map(chat => {
+            if (chat.id === activeChatId) {
+              return {
+                ...chat,
+                messages: [...chat.messages, assistantMessage],
+                lastMessageAt: new Date()
+              };
+            }
+            return chat;
+          }));
+        }
+      } else if (data.tokens && Array.isArray(data.tokens)) {
         let accumulatedText = "";
         
         for (const token of data.tokens) {
@@ -463,6 +497,9 @@ const Index = () => {
         }
       }
     } catch (error: any) {
+      // Aborted because the page was left or a newer query replaced this one
+      if (error.name === 'AbortError') return;
+      
       toast({
         title: "Error processing query",
         description: error.message || "Failed to process your query.",
@@ -488,8 +525,11 @@ const Index = () => {
         }));
       }
     } finally {
-      setIsLoading(false);
-      setStreamingContent("");
+      if (queryAbortRef.current === controller) {
+        queryAbortRef.current = null;
+        setIsLoading(false);
+        setStreamingContent("");
+      }
     }
   };
 